@@ -1,20 +1,27 @@
 # app.py
 import os
 import re
+import time
 import base64
-from collections import defaultdict
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from pymongo import MongoClient
 import gridfs
-import fitz  # PyMuPDF
 import requests
+from requests.adapters import HTTPAdapter
 
-# Optional libs (only used if provided)
-try:
-    import stripe
-except Exception:
-    stripe = None
+# PyMuPDF, Stripe and OpenAI are imported lazily by the pages that use them,
+# so landing on the home page doesn't pay for them.
 
 # ============== PAGE CONFIG ==============
 st.set_page_config(
@@ -53,76 +60,135 @@ PRO_PRICE_ID = (
     or os.getenv("PRO_PRICE_ID", "price_pro_monthly")  # placeholder
 )
 
-if stripe and STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
-
 # ============== OPENAI CLIENT (supports new & old SDKs) ==============
-_openai_mode = None
-_openai_client = None
-try:
-    # New SDK style
-    from openai import OpenAI
-    if OPENAI_API_KEY:
-        _openai_client = OpenAI(api_key=OPENAI_API_KEY)
-        _openai_mode = "new"
-except Exception:
-    pass
-
-if _openai_mode is None:
-    # Try old SDK as a fallback
+@st.cache_resource(show_spinner=False)
+def _get_openai_client():
+    """Return (mode, client): ("new", OpenAI), ("old", openai module) or (None, None)."""
+    if not OPENAI_API_KEY:
+        return None, None
     try:
-        import openai  # old SDK
-        if OPENAI_API_KEY:
-            openai.api_key = OPENAI_API_KEY
-            _openai_mode = "old"
+        # New SDK style
+        from openai import OpenAI
+        return "new", OpenAI(api_key=OPENAI_API_KEY)
     except Exception:
         pass
+    try:
+        # Try old SDK as a fallback
+        import openai  # old SDK
+        openai.api_key = OPENAI_API_KEY
+        return "old", openai
+    except Exception:
+        return None, None
+
+
+_fitz_mod = None
+
+
+def _fitz():
+    """Import PyMuPDF on first use."""
+    global _fitz_mod
+    if _fitz_mod is None:
+        import fitz  # PyMuPDF
+        _fitz_mod = fitz
+    return _fitz_mod
 
 # ============== MongoDB Setup ==============
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/")
+
+
+@st.cache_resource(show_spinner=False)
+def get_mongo():
+    """Create the Mongo client once per process; reruns reuse it without re-pinging."""
+    c = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000, maxPoolSize=20)
+    c.server_info()  # quick ping; raising here keeps a failed connect out of the cache
+    d = c["data"]
+    try:
+        d["fs.files"].create_index("filename")
+    except Exception:
+        pass  # read-only users can still query without it
+    return c, d, gridfs.GridFS(d)
+
+
 try:
-    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
-    db = client["data"]
-    fs = gridfs.GridFS(db)
+    client, db, fs = get_mongo()
     _mongo_ok = True
-    client.server_info()  # quick ping
 except Exception:
     _mongo_ok = False
     fs = None
 
 DATA_DIR = "data"
 TEMP_DIR = "temp_pdfs"
-os.makedirs(DATA_DIR, exist_ok=True)
-os.makedirs(TEMP_DIR, exist_ok=True)
+
+
+@st.cache_resource(show_spinner=False)
+def _boot() -> bool:
+    """Create the working directories once per process instead of on every rerun."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    return True
+
+
+_boot()
 
 # ============== Session State Initialization ==============
-def init_session_state():
-    st.session_state.setdefault("search_count", 0)
-    st.session_state.setdefault("locked", False)
-    st.session_state.setdefault("show_plans", False)
-    st.session_state.setdefault("user_email", "")
-    st.session_state.setdefault("subscription_status", None)
-    st.session_state.setdefault("current_page", "home")
-    st.session_state.setdefault("show_subscription_popup", False)
+_SESSION_DEFAULTS = (
+    ("search_count", 0),
+    ("locked", False),
+    ("show_plans", False),
+    ("user_email", ""),
+    ("subscription_status", None),
+    ("current_page", "home"),
+    ("show_subscription_popup", False),
+)
+
 
-init_session_state()
+def init_session_state():
+    ss = st.session_state
+    for key, value in _SESSION_DEFAULTS:
+        ss.setdefault(key, value)
 
 # ============== Upload Local PDFs to MongoDB ==============
+def _file_md5(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 def upload_pdfs_to_mongo(folder_path: str) -> int:
-    """Upload all PDFs in DATA_DIR to GridFS if not already present."""
+    """Upload all PDFs in DATA_DIR to GridFS if not already present (by name or content)."""
     if not _mongo_ok:
         return 0
     uploaded = 0
-    for filename in os.listdir(folder_path):
-        if not filename.lower().endswith(".pdf"):
+    local = [f for f in os.listdir(folder_path) if f.lower().endswith(".pdf")]
+    try:
+        existing = {
+            d["filename"]
+            for d in db["fs.files"].find({"filename": {"$in": local}}, {"filename": 1, "_id": 0})
+        }
+        # Hash only files whose name is new, to catch renamed copies of stored PDFs.
+        hashes = {}
+        for filename in local:
+            if filename not in existing:
+                hashes[filename] = _file_md5(os.path.join(folder_path, filename))
+        existing_hashes = {
+            d["md5"]
+            for d in db["fs.files"].find({"md5": {"$in": list(hashes.values())}}, {"md5": 1, "_id": 0})
+        } if hashes else set()
+    except Exception as e:
+        st.warning(f" Failed to list uploaded PDFs: {e}")
+        return 0
+    for filename, md5 in hashes.items():
+        if md5 in existing_hashes:
             continue
         try:
-            if fs.find_one({"filename": filename}):
-                continue
             file_path = os.path.join(folder_path, filename)
             with open(file_path, "rb") as f:
-                fs.put(f.read(), filename=filename)
+                # PyMongo 4 no longer computes GridFS md5, so store it ourselves.
+                fs.put(f, filename=filename, md5=md5)
                 uploaded += 1
+            existing_hashes.add(md5)
         except Exception as e:
             st.warning(f" Failed to upload {filename}: {e}")
     return uploaded
@@ -132,97 +198,210 @@ if _mongo_ok:
 
 # ============== Utility Functions ==============
 
+# name format example: 9702_m24_qp_22.pdf
+_QP_RE = re.compile(r"^(?P<code>\d+)_(?P<mo>[msw])(?P<yr>\d{2})_qp_(?P<pn>\d+)\.pdf$", re.I)
+_MONTH_MAP = {"m": "March", "s": "May–June", "w": "Oct–Nov"}
+_MCQ_RE = re.compile(r"1[123]\.pdf$")
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_qp_sessions():
+    """Cached session listing; raises on read errors so a failed read is never cached."""
+    session_dict = defaultdict(list)
+    # Only the filename is needed; let Mongo filter and project instead of streaming full file docs.
+    for doc in db["fs.files"].find({"filename": {"$regex": "_qp_"}}, {"filename": 1, "_id": 0}):
+        name = doc["filename"]
+        m = _QP_RE.match(name)
+        if not m:
+            continue
+        session_name = f"20{m['yr']}-{_MONTH_MAP[m['mo'].lower()]}"
+        session_dict[session_name].append(name)
+    # newest first (string sort is fine due to YYYY- prefix)
+    return dict(sorted(session_dict.items(), key=lambda x: x[0], reverse=True))
+
+
 def get_qp_files_by_session():
     """Return {session_name: [qp_filenames...]} with newest sessions first."""
     if not _mongo_ok:
         return {}
-    session_dict = defaultdict(list)
     try:
-        for file in fs.find():
-            name = file.filename
-            if "_qp_" in name:
-                parts = name.split("_")
-                if len(parts) >= 3:
-                    # name format example: 9702_m24_qp_22.pdf
-                    code, session, _ = parts[:3]
-                    if len(session) >= 2:
-                        year = "20" + session[1:3]
-                        month_code = session[0].lower()
-                        month_map = {"m": "March", "s": "May–June", "w": "Oct–Nov"}
-                        month = month_map.get(month_code, session)
-                        session_name = f"{year}-{month}"
-                        session_dict[session_name].append(name)
+        return _load_qp_sessions()
     except Exception as e:
         st.error(f"Mongo read error: {e}")
         return {}
-    # newest first (string sort is fine due to YYYY- prefix)
-    return dict(sorted(session_dict.items(), key=lambda x: x[0], reverse=True))
 
 
-def get_pdf_file(filename: str):
-    if not _mongo_ok:
-        return None
+def get_pdf_file_cached(filename: str) -> str:
+    """Materialise the latest GridFS version under TEMP_DIR, reusing the local copy while it matches."""
+    path = os.path.join(TEMP_DIR, filename)
+    try:
+        grid_out = fs.get_last_version(filename=filename)
+    except gridfs.errors.NoFile:
+        raise FileNotFoundError(filename) from None
+    # A re-uploaded version differs in size or is newer than the file on disk.
+    uploaded = grid_out.upload_date.replace(tzinfo=timezone.utc).timestamp()
+    if (os.path.exists(path) and os.path.getsize(path) == grid_out.length
+            and os.path.getmtime(path) >= uploaded):
+        return path
+    # Stream into a per-call temp file, then rename: concurrent sessions never share a
+    # partial file, and an interrupted download never looks like a cached one.
+    with tempfile.NamedTemporaryFile("wb", dir=TEMP_DIR, suffix=".part", delete=False) as f:
+        tmp_path = f.name
+        try:
+            shutil.copyfileobj(grid_out, f, 1 << 20)
+        except BaseException:
+            f.close()
+            os.unlink(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return path
+
+
+def _resolve_pdf(filename: str, fetch):
     try:
-        file = fs.find_one({"filename": filename})
-        if file:
-            path = os.path.join(TEMP_DIR, filename)
-            with open(path, "wb") as f:
-                f.write(file.read())
-            return path
+        return fetch()
+    except FileNotFoundError:
+        pass
     except Exception as e:
         st.error(f"Failed to fetch {filename}: {e}")
     return None
 
 
+def get_pdf_files(*filenames: str) -> list:
+    """Fetch several GridFS files concurrently; returns paths (or None) in order."""
+    if not _mongo_ok:
+        return [None] * len(filenames)
+    # Only the GridFS download runs in the workers; st.* error reporting stays on the script thread.
+    # The workers still get this run's ScriptRunContext so any Streamlit call there is attributed
+    # to the session instead of logging "missing ScriptRunContext".
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=len(filenames) or 1,
+                            initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+        futures = [ex.submit(get_pdf_file_cached, name) for name in filenames]
+        return [_resolve_pdf(name, fut.result) for name, fut in zip(filenames, futures)]
+
+
+def _text_flags() -> int:
+    # Plain-text extraction only: keep whitespace for the line-anchored regexes, clip to
+    # the page, and let ligatures expand to ordinary letters (no TEXT_PRESERVE_LIGATURES).
+    fitz = _fitz()
+    return fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+
+def _doc_text(doc) -> str:
+    flags = _text_flags()
+    return "".join(page.get_text("text", flags=flags, sort=False) for page in doc)
+
+
+@st.cache_data(show_spinner=False)
+def extract_text_cached(path: str, mtime: float) -> str:
+    """Extract plain text from a PDF; cached on (path, mtime) so reruns skip PyMuPDF.
+
+    Raises on failure so a transient error is never cached.
+    """
+    with _fitz().open(path) as doc:
+        return _doc_text(doc)
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
 def extract_text(path: str) -> str:
-    text = ""
     try:
-        with fitz.open(path) as doc:
-            for page in doc:
-                text += page.get_text()
+        return extract_text_cached(path, _mtime(path))
     except Exception as e:
         st.error(f"PDF text extraction failed ({os.path.basename(path)}): {e}")
-    return text
+    return ""
+
+
+# Next token: start of another question number with optional chained parts
+# Examples: 3, 3(a), 3(a)(ii), 12(c)(iv)
+_NEXT_TOKEN_RE = re.compile(r"^\s*\d+(\([a-z]\))*(\([ivxl]+\))*\b", re.M)
+
 
+@lru_cache(maxsize=256)
+def _compile_block_pattern(q: str):
+    """Compile (once per question token) the regex matching the question's first line."""
+    return re.compile(rf"(?m)^\s*{re.escape(q.strip())}[^\n]*\n")
 
-def _extract_block(text: str, q: str) -> str:
+
+def _block_span(text: str, pattern):
+    """
+    Return (start, end) of the block whose first line `pattern` matches
+    (see _compile_block_pattern), or None if it isn't in `text`.
+    Two phases, both linear: find the anchored start line, then scan forward for
+    the next question token (or end of text). No backtracking across lines.
+    """
+    m = pattern.search(text)
+    if not m:
+        return None
+    nxt = _NEXT_TOKEN_RE.search(text, m.end())
+    return m.start(), nxt.start() if nxt else len(text)
+
+
+def _extract_block(text: str, pattern) -> str:
     """
     Extracts the block starting from the line that begins with the question token
-    until the next question token or end of text.
-    Supports tokens like 3, 3(a), 3(b)(ii).
+    (matched by `pattern` from _compile_block_pattern) until the next question
+    token or end of text. Supports tokens like 3, 3(a), 3(b)(ii).
     """
     if not text.strip():
         return " Not found (empty text)."
 
-    escaped_q = re.escape(q.strip())
-    # Next token: start of another question number with optional chained parts
-    # Examples: 3, 3(a), 3(a)(ii), 12(c)(iv)
-    next_token = r"^\s*\d+(\([a-z]\))*(\([ivxl]+\))*\b"
+    span = _block_span(text, pattern)
+    return text[span[0]:span[1]].strip() if span else " Not found."
 
-    # Multiline + dotall so ^/$ apply line-wise
-    pattern = rf"(?ms)^\s*{escaped_q}[^\n]*\n(?:.*?\n)*?(?={next_token}|\Z)"
-    m = re.search(pattern, text)
-    return m.group(0).strip() if m else " Not found."
+
+@st.cache_data(show_spinner=False)
+def extract_block_streaming(path: str, mtime: float, q: str) -> str:
+    """
+    Return the text of just the pages spanning question `q`.
+    Pages are parsed one at a time and parsing stops as soon as the block for `q`
+    is followed by another question token, so later pages are never extracted.
+    Raises on failure so a transient error is never cached.
+    """
+    pattern = _compile_block_pattern(q)
+    buf = ""
+    page_starts = []
+    flags = _text_flags()
+    with _fitz().open(path) as doc:
+        for page in doc:
+            page_starts.append(len(buf))
+            buf += page.get_text("text", flags=flags, sort=False)
+            span = _block_span(buf, pattern)
+            if not span:
+                # Token not seen yet; only the latest page can still hold its line.
+                buf, page_starts = buf[page_starts[-1]:], [0]
+                continue
+            # Drop pages before the one the block starts on.
+            first = max(o for o in page_starts if o <= span[0])
+            buf, page_starts = buf[first:], [o - first for o in page_starts if o >= first]
+            if span[1] - first < len(buf):
+                break  # next question token found
+    return buf
 
 
-def extract_specific_question(text: str, question_number: str) -> str:
-    return _extract_block(text, question_number)
+def extract_question_text(path: str, q: str) -> str:
+    try:
+        return extract_block_streaming(path, _mtime(path), q)
+    except Exception as e:
+        st.error(f"PDF text extraction failed ({os.path.basename(path)}): {e}")
+    return ""
 
 
-def extract_specific_answer(text: str, question_number: str) -> str:
-    return _extract_block(text, question_number)
 
 def extract_file_name(filename: str) -> str:
-    if filename.endswith(("11.pdf", "12.pdf", "13.pdf")):
+    if _MCQ_RE.search(filename):
         return "MCQ"
     return "Question"
 
-def ask_llm(qp_text: str, ms_text: str, question_number: str, name: str) -> str:
-    question = extract_specific_question(qp_text, question_number)
-    answer = extract_specific_answer(ms_text, question_number)
-    fileName = extract_file_name(name)
-
-    prompt = f"""You are a helpful A-Level Physics tutor.
+# Fixed tutor instructions, sent as the system message on every call. Too short (<1024 tokens)
+# for OpenAI's prompt caching today; it keeps the per-call string building to the user message.
+_SYSTEM_PROMPT = """You are a helpful A-Level Physics tutor.
 
 You will be given a question and its official marking scheme answer.
 
@@ -231,15 +410,6 @@ Your job is to:
 - DO NOT add anything not already in the answer.
 - Use easy language that a student can understand.
 
---- Question ---
-{question}
-
---- Official Answer ---
-{answer}
-
--- FileName --
-{fileName}
-
 if the FileName is MCQ then read the Question and suggest why it is the correct answer.
 if the FileName is Question ... then read and explain answer only (Now explain the answer step-by-step, without adding anything extra.)
 
@@ -250,35 +420,191 @@ All other math related stuff that requires special display also needs to be encl
 We have added you as a backend prompt handling bot. You just need to answer what st.markdown(result) can handle.
 """
 
+
+def _build_messages(user_content: str) -> list:
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def _build_prompt(qp_text: str, ms_text: str, question_number: str, name: str) -> str:
+    # QP and MS share one compiled pattern for this question.
+    pat = _compile_block_pattern(question_number)
+    question = _extract_block(qp_text, pat)
+    answer = _extract_block(ms_text, pat)
+    return f"Question:\n{question}\n\nOfficial Answer:\n{answer}\n\nFileName: {extract_file_name(name)}"
+
+
+def ask_llm_stream(qp_text: str, ms_text: str, question_number: str, name: str):
+    """Yield the explanation text chunk-by-chunk as the model generates it."""
+    prompt = _build_prompt(qp_text, ms_text, question_number, name)
+
     try:
-        if _openai_mode == "new" and _openai_client:
-            resp = _openai_client.chat.completions.create(
+        mode, client = _get_openai_client()
+        if mode == "new":
+            stream = client.chat.completions.create(
                 model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
+                messages=_build_messages(prompt),
                 temperature=0.2,
                 max_tokens=800,
+                stream=True,
             )
-            return (resp.choices[0].message.content or "").strip()
-        elif _openai_mode == "old":
-            import openai  # type: ignore
-            resp = openai.ChatCompletion.create(
+            for chunk in stream:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or ""
+        elif mode == "old":
+            stream = client.ChatCompletion.create(
                 model="gpt-4",
-                messages=[{"role": "user", "content": prompt}],
+                messages=_build_messages(prompt),
                 temperature=0.2,
                 max_tokens=800,
+                stream=True,
+            )
+            for chunk in stream:
+                yield chunk["choices"][0]["delta"].get("content", "")
+        else:
+            yield " AI Error: OpenAI client not configured. Add your OPENAI_API_KEY to .streamlit/secrets.toml."
+    except Exception as e:
+        yield f" AI Error: {e}"
+
+
+def _coalesce(chunks, min_chars: int = 50):
+    """Regroup streamed text into pieces of at least `min_chars` to cut UI update frames."""
+    buf = []
+    size = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= min_chars:
+            yield "".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf)
+
+
+def ask_llm(qp_text: str, ms_text: str, question_number: str, name: str) -> str:
+    return "".join(ask_llm_stream(qp_text, ms_text, question_number, name)).strip()
+
+
+_EXPLANATION_CACHE_MAX = 512
+
+
+@st.cache_resource(show_spinner=False)
+def _explanation_cache():
+    """Process-wide LRU of {(paper, text digest, question_number): explanation} plus its lock."""
+    return OrderedDict(), threading.Lock()
+
+
+def _parse_batch_answers(content: str) -> dict:
+    # Models without JSON mode may wrap the object in prose or ``` fences.
+    start, end = content.find("{"), content.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("no JSON object in the reply")
+    answers = json.loads(content[start:end + 1])
+    if not isinstance(answers, dict):
+        raise ValueError("reply is not a JSON object")
+    return answers
+
+
+def _build_batch_prompt(qp_text: str, ms_text: str, qnums, name: str) -> str:
+    sections = []
+    for q in qnums:
+        pat = _compile_block_pattern(q)
+        sections.append(
+            f"Question {q}:\n{_extract_block(qp_text, pat)}\n\n"
+            f"Official Answer {q}:\n{_extract_block(ms_text, pat)}\n"
+        )
+    blocks = "\n".join(sections)
+    return (
+        f"{blocks}\nFileName: {extract_file_name(name)}\n\n"
+        f"Explain each of these questions separately. Return ONLY a JSON object whose keys are "
+        f"the question numbers exactly as written above ({', '.join(qnums)}) and whose values are the explanations."
+    )
+
+
+# Questions per completion: 4 x 800 output tokens stays well inside both models' limits.
+_BATCH_SIZE = 4
+
+
+def _request_batch(qp_text: str, ms_text: str, batch: list[str], name: str) -> dict:
+    """One chat completion for up to _BATCH_SIZE questions; returns {qnum: text or error}."""
+    prompt = _build_batch_prompt(qp_text, ms_text, batch, name)
+    try:
+        mode, client = _get_openai_client()
+        if mode == "new":
+            resp = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=_build_messages(prompt),
+                temperature=0.2,
+                max_tokens=800 * len(batch),
+                response_format={"type": "json_object"},
+            )
+        elif mode == "old":
+            resp = client.ChatCompletion.create(
+                model="gpt-4",
+                messages=_build_messages(prompt),
+                temperature=0.2,
+                max_tokens=800 * len(batch),
             )
-            return (resp.choices[0].message.content or "").strip()
         else:
-            return " AI Error: OpenAI client not configured. Add your OPENAI_API_KEY to .streamlit/secrets.toml."
+            err = "AI Error: OpenAI client not configured. Add your OPENAI_API_KEY to .streamlit/secrets.toml."
+            return {q: err for q in batch}
+        content = resp.choices[0].message.content or ""
     except Exception as e:
-        return f" AI Error: {e}"
+        return {q: f"AI Error: {e}" for q in batch}
+
+    try:
+        return _parse_batch_answers(content)
+    except ValueError:
+        # Unparseable batch reply: explain the questions one by one instead.
+        return {q: ask_llm(qp_text, ms_text, q, name) for q in batch}
+
+
+def ask_llm_batch(qp_text: str, ms_text: str, qnums: list[str], name: str) -> dict[str, str]:
+    """Explain several questions from one paper, _BATCH_SIZE questions per chat completion."""
+    cache, lock = _explanation_cache()
+    # Keyed on the extracted text too, so a new version of either paper misses.
+    digest = hashlib.sha256(f"{qp_text}\0{ms_text}".encode("utf-8")).hexdigest()
+    results = {}
+    with lock:
+        for q in qnums:
+            key = (name, digest, q)
+            if key in cache:
+                cache.move_to_end(key)
+                results[q] = cache[key]
+    missing = [q for q in qnums if q not in results]
+
+    for i in range(0, len(missing), _BATCH_SIZE):
+        batch = missing[i:i + _BATCH_SIZE]
+        answers = _request_batch(qp_text, ms_text, batch, name)
+        for q in batch:
+            text = str(answers.get(q, "")).strip()
+            if text and not text.startswith("AI Error"):
+                with lock:
+                    cache[(name, digest, q)] = text
+                    while len(cache) > _EXPLANATION_CACHE_MAX:
+                        cache.popitem(last=False)
+                results[q] = text
+            elif text:
+                results[q] = f" {text}"
+            else:
+                results[q] = " AI Error: no explanation returned for this question."
+    return results
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _pdf_b64(path: str, mtime: float) -> str:
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
 
 
 def display_pdf_inline(path: str, zoom_percent: int = 100, height_px: int = 800) -> str:
     """Embed a PDF inline. Width is responsive; zoom affects CSS scale."""
     try:
-        with open(path, "rb") as f:
-            base64_pdf = base64.b64encode(f.read()).decode("utf-8")
+        base64_pdf = _pdf_b64(path, os.path.getmtime(path))
         scale = max(50, min(200, int(zoom_percent))) / 100.0
         return f"""
         <div style="width:100%; border:1px solid #e9ecef; border-radius:8px; overflow:auto">
@@ -292,56 +618,107 @@ def display_pdf_inline(path: str, zoom_percent: int = 100, height_px: int = 800)
         return "<div class='error-alert'> Unable to render PDF inline.</div>"
 
 
-def file_info(path: str):
+@st.cache_data(show_spinner=False)
+def _file_info_cached(path: str, mtime: float):
     try:
-        with fitz.open(path) as doc:
-            return len(doc), os.path.getsize(path)
+        with _fitz().open(path) as doc:
+            return doc.page_count, os.path.getsize(path)
     except Exception:
         return 0, 0
 
 
-def check_user_subscription(email: str):
+def file_info(path: str):
+    return _file_info_cached(path, _mtime(path))
+
+
+@st.cache_resource(show_spinner=False)
+def _get_http() -> requests.Session:
+    """Shared keep-alive session (one per process) so backend calls reuse pooled connections."""
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+    return session
+
+
+# Deliberately memory-only: persist="disk" makes Streamlit ignore ttl, so a
+# cached status would never refresh after a payment or cancellation.
+@st.cache_data(ttl=60, show_spinner=False, max_entries=2048)
+def _cached_fetch_subscription(email: str) -> dict:
+    """Per-email cached backend lookup; call .clear() after the status changes.
+
+    Raises on any failure so only real answers are cached.
+    """
+    resp = _get_http().post(f"{BACKEND_URL}/check-subscription", json={"email": email}, timeout=5)
+    if resp.status_code != 200:
+        raise RuntimeError(f"check-subscription returned HTTP {resp.status_code}")
+    return resp.json()
+
+
+def check_user_subscription(email: str) -> dict:
     """Check subscription status from your backend; returns a dict."""
     if not BACKEND_URL:
         return {"has_subscription": False}
     try:
-        resp = requests.post(f"{BACKEND_URL}/check-subscription", json={"email": email}, timeout=5)
-        if resp.status_code == 200:
-            return resp.json()
+        return _cached_fetch_subscription(email)
     except Exception:
-        pass
-    return {"has_subscription": False}
+        # Transient backend error: treat as free for this run only.
+        return {"has_subscription": False}
 
 
-def redirect_to_stripe_checkout(plan: str, email: str):
-    """Create Stripe checkout session and show link."""
-    if not stripe or not STRIPE_SECRET_KEY:
-        st.error("Stripe is not configured. Add STRIPE_SECRET_KEY and STRIPE_PUBLISHABLE_KEY to secrets.")
-        return
+def _create_checkout_url(plan: str, email: str, current_url: str, bucket: int) -> str:
+    """Create a Stripe Checkout Session and return its URL.
 
+    ``bucket`` is a 5-minute time slot, so repeat clicks within the same slot
+    reuse the session without a Stripe round trip.
+    """
+    import stripe
+    stripe.api_key = STRIPE_SECRET_KEY
     price_ids = {
         'basic': BASIC_PRICE_ID,
         'plus': PLUS_PRICE_ID,
         'pro': PRO_PRICE_ID
     }
+    checkout_session = stripe.checkout.Session.create(
+        payment_method_types=['card'],
+        customer_email=email,
+        line_items=[{'price': price_ids[plan], 'quantity': 1}],
+        mode='subscription',
+        success_url=f"{current_url}?success=true&plan={plan}",
+        cancel_url=f"{current_url}?canceled=true",
+        metadata={'plan': plan, 'user_email': email}
+    )
+    return checkout_session.url
+
+
+@st.cache_resource(show_spinner=False)
+def _checkout_url():
+    """Process-wide lru_cache over _create_checkout_url.
+
+    Held in st.cache_resource because a module-level @lru_cache is rebuilt
+    every time Streamlit re-executes the script.
+    """
+    return lru_cache(maxsize=1024)(_create_checkout_url)
+
+
+def redirect_to_stripe_checkout(plan: str, email: str):
+    """Create Stripe checkout session and show link."""
+    try:
+        import stripe
+    except Exception:
+        stripe = None
+    if not stripe or not STRIPE_SECRET_KEY:
+        st.error("Stripe is not configured. Add STRIPE_SECRET_KEY and STRIPE_PUBLISHABLE_KEY to secrets.")
+        return
 
-    if plan not in price_ids:
+    if plan not in ('basic', 'plus', 'pro'):
         st.error("Invalid plan selected.")
         return
 
     try:
         # Fallback host if query param not present
-        current_url = (st.query_params.get("host_url") or ["http://localhost:8501"])[0]
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            customer_email=email,
-            line_items=[{'price': price_ids[plan], 'quantity': 1}],
-            mode='subscription',
-            success_url=f"{current_url}?success=true&plan={plan}",
-            cancel_url=f"{current_url}?canceled=true",
-            metadata={'plan': plan, 'user_email': email}
-        )
-        st.markdown(f"[ Proceed to Checkout]({checkout_session.url})")
+        current_url = st.query_params.get("host_url") or "http://localhost:8501"
+        url = _checkout_url()(plan, email, current_url, int(time.time() // 300))
+        st.markdown(f"[ Proceed to Checkout]({url})")
         st.info("Click the link above to open the secure Stripe checkout.")
     except Exception as e:
         st.error(f"Error creating checkout session: {e}")
@@ -411,11 +788,7 @@ def load_css():
 load_css()
 
 # ============== Subscription Popup Component ==============
-def render_subscription_popup():
-    if not st.session_state.show_subscription_popup:
-        return
-
-    popup_html = """
+_POPUP_HTML = """
     <div class="popup-overlay" id="subscriptionPopup">
         <div class="popup-content">
             <button class="close-button" onclick="document.getElementById('subscriptionPopup').style.display='none'">&times;</button>
@@ -462,7 +835,9 @@ def render_subscription_popup():
     </div>
     """
 
-    st.markdown(popup_html, unsafe_allow_html=True)
+
+def render_subscription_popup():
+    st.markdown(_POPUP_HTML, unsafe_allow_html=True)
 
 # ============== Header Section ==============
 def render_header():
@@ -495,10 +870,12 @@ def render_navigation():
     st.markdown('</div>', unsafe_allow_html=True)
 
 # ============== User Stats ==============
-def render_user_stats():
-    if not st.session_state.user_email:
+def render_user_stats(subscription=None):
+    ss = st.session_state
+    if not ss.user_email:
         return
-    subscription = check_user_subscription(st.session_state.user_email)
+    if subscription is None:
+        subscription = check_user_subscription(ss.user_email)
     if subscription.get("has_subscription"):
         searches_used = subscription.get("searches_used", 0)
         search_limit = subscription.get("search_limit", 10)
@@ -562,13 +939,15 @@ def render_home_page():
 
 # ============== Question Explainer Page ==============
 def render_explainer_page():
+    ss = st.session_state
     st.markdown("##  Question Explainer")
-    render_user_stats()
+    sub = check_user_subscription(ss.user_email) if ss.user_email else {}
+    has_sub = sub.get("has_subscription", False)
+    render_user_stats(sub)
 
     sessions = get_qp_files_by_session()
     if not sessions:
         st.markdown('<div class="warning-alert"> No question papers found in the database or MongoDB not reachable.</div>', unsafe_allow_html=True)
-        st.markdown('</div>', unsafe_allow_html=True)
         return
 
     with st.sidebar:
@@ -578,8 +957,7 @@ def render_explainer_page():
 
     if selected_qp:
         selected_ms = selected_qp.replace("_qp_", "_ms_")
-        qp_path = get_pdf_file(selected_qp)
-        ms_path = get_pdf_file(selected_ms)
+        qp_path, ms_path = get_pdf_files(selected_qp, selected_ms)
 
         if not qp_path or not ms_path:
             st.markdown('<div class="error-alert"> Could not load PDF files from database.</div>', unsafe_allow_html=True)
@@ -605,193 +983,140 @@ def render_explainer_page():
 
             st.markdown("---")
             st.subheader(" Get AI Explanation")
-            question_number = st.text_input("Enter Question Number (e.g., 3, 3(a), 3(b)(ii))", key="qnum")
+            question_number = st.text_input(
+                "Enter Question Number (e.g., 3, 3(a), 3(b)(ii)); separate several with commas", key="qnum"
+            )
             explain_btn = st.button(" Explain")
+            qnums = [q.strip() for q in question_number.split(",") if q.strip()]
 
-            if explain_btn and question_number.strip():
+            if explain_btn and qnums:
                 # Check free limit logic
-                has_sub = False
-                if st.session_state.user_email:
-                    sub = check_user_subscription(st.session_state.user_email)
-                    has_sub = sub.get("has_subscription", False)
-
                 if not has_sub:
-                    st.session_state['search_count'] += 1
-                    if st.session_state['search_count'] > 3:
-                        st.session_state['locked'] = True
-                        st.session_state['show_subscription_popup'] = True
+                    ss.search_count += len(qnums)
+                    if ss.search_count > 3:
+                        ss.locked = True
+                        ss.show_subscription_popup = True
 
-                if st.session_state['locked'] and not has_sub:
+                if ss.locked and not has_sub:
+                    # The router renders the popup once after the page.
                     st.warning("You've reached the free limit (3). Please upgrade to continue.")
-                    render_subscription_popup()
-                else:
+                elif len(qnums) == 1:
                     with st.spinner("Thinking..."):
-                        qp_text = extract_text(qp_path)
-                        ms_text = extract_text(ms_path)
-                        explanation = ask_llm(qp_text, ms_text, question_number, qp_path)
+                        qp_text = extract_question_text(qp_path, qnums[0])
+                        ms_text = extract_question_text(ms_path, qnums[0])
                     st.markdown("### ✅ Explanation")
-                    st.markdown(explanation)
-
-    st.markdown('</div>', unsafe_allow_html=True)
+                    st.write_stream(_coalesce(ask_llm_stream(qp_text, ms_text, qnums[0], qp_path)))
+                else:
+                    with st.spinner("Thinking..."):
+                        explanations = ask_llm_batch(extract_text(qp_path), extract_text(ms_path), qnums, qp_path)
+                    for q in qnums:
+                        st.markdown(f"### ✅ Explanation: {q}")
+                        st.markdown(explanations[q])
 
 # ============== Subscription Page ==============
-def render_subscription_page():
-    # Add CSS for equal height cards
-    st.markdown(
-        """
-        <style>
-        .plan-card {
-            display: flex;
-            flex-direction: column;
-            justify-content: space-between;
-            height: 100%; /* Ensures all cards have equal height */
-        }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
+# (slug, title, price, features, popular)
+_PLANS = (
+    ("basic", "Basic", "$5", ("50 explanations/month", "All question papers", "PDF downloads", "Basic support"), False),
+    ("plus", "Plus", "$20", ("200 explanations/month", "All question papers", "PDF downloads", "Priority support",
+                             "Advanced analytics"), True),
+    ("pro", "Pro", "$100", ("1000 explanations/month", "All question papers", "PDF downloads", "Premium support",
+                            "Advanced analytics", "Custom uploads"), False),
+)
 
+
+def render_subscription_page():
+    ss = st.session_state
     st.markdown("## 💳 Subscription")
 
     st.info("Add your email, pick a plan, and proceed to Stripe checkout.")
 
     # Input for user email
-    email = st.text_input("Email for subscription receipts", value=st.session_state.user_email)
+    email = st.text_input("Email for subscription receipts", value=ss.user_email)
     if email:
-        st.session_state.user_email = email
+        ss.user_email = email
 
     # Subscription plans layout
-    col1, col2, col3 = st.columns(3)
-
-    # Basic Plan
-    with col1:
-        st.markdown(
-            """
-            <div class="plan-card">
-                <div class="plan-title">Basic</div>
-                <div class="plan-price">$5<span>/mo</span></div>
-                <ul class="plan-features">
-                    <li>50 explanations/month</li>
-                    <li>All question papers</li>
-                    <li>PDF downloads</li>
-                    <li>Basic support</li>
-                </ul>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        if st.button("Choose Basic"):
-            if not st.session_state.user_email:
-                st.warning("Please enter your email above first.")
-            else:
-                redirect_to_stripe_checkout('basic', st.session_state.user_email)
-
-    # Plus Plan
-    with col2:
-        st.markdown(
-            """
-            <div class="plan-card popular">
-                <div class="plan-title">Plus</div>
-                <div class="plan-price">$20<span>/mo</span></div>
-                <ul class="plan-features">
-                    <li>200 explanations/month</li>
-                    <li>All question papers</li>
-                    <li>PDF downloads</li>
-                    <li>Priority support</li>
-                    <li>Advanced analytics</li>
-                </ul>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        if st.button("Choose Plus"):
-            if not st.session_state.user_email:
-                st.warning("Please enter your email above first.")
-            else:
-                redirect_to_stripe_checkout('plus', st.session_state.user_email)
-
-    # Pro Plan
-    with col3:
-        st.markdown(
-            """
-            <div class="plan-card">
-                <div class="plan-title">Pro</div>
-                <div class="plan-price">$100<span>/mo</span></div>
-                <ul class="plan-features">
-                    <li>1000 explanations/month</li>
-                    <li>All question papers</li>
-                    <li>PDF downloads</li>
-                    <li>Premium support</li>
-                    <li>Advanced analytics</li>
-                    <li>Custom uploads</li>
-                </ul>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        if st.button("Choose Pro"):
-            if not st.session_state.user_email:
-                st.warning("Please enter your email above first.")
-            else:
-                redirect_to_stripe_checkout('pro', st.session_state.user_email)
+    for col, (slug, title, price, features, popular) in zip(st.columns(3), _PLANS):
+        with col, st.container(border=True):
+            badge = "⭐ *MOST POPULAR*\n\n" if popular else ""
+            st.markdown(f"### {title}\n\n{badge}**{price}**/mo\n\n" + "\n".join(f"- {f}" for f in features))
+            if st.button(f"Choose {title}", key=f"choose_{slug}"):
+                if not ss.user_email:
+                    st.warning("Please enter your email above first.")
+                else:
+                    redirect_to_stripe_checkout(slug, ss.user_email)
 
     # Success / cancel feedback via query params (?success=true or ?canceled=true)
-    if st.query_params.get("success") == ["true"]:
+    if st.query_params.get("success") == "true":
         st.success("🎉 Payment successful! Your subscription is now active.")
-        st.session_state.show_subscription_popup = False
+        _cached_fetch_subscription.clear()
+        ss.show_subscription_popup = False
         st.balloons()
-    if st.query_params.get("canceled") == ["true"]:
+    if st.query_params.get("canceled") == "true":
         st.warning("Payment was canceled. You can try again anytime.")
-
-    st.markdown('</div>', unsafe_allow_html=True)
+        _checkout_url().cache_clear()  # next attempt gets a fresh session
+    # Handled once; later reruns skip straight past these checks. Drop only the
+    # Stripe return params so host_url survives for the next checkout.
+    for key in ("success", "canceled", "plan"):
+        if key in st.query_params:
+            del st.query_params[key]
 
 # ============== Account Page ==============
 def render_account_page():
+    ss = st.session_state
     st.markdown("## 📊 My Account")
 
     st.text_input("Email", key="user_email")
     if st.button("Check Subscription"):
-        if not st.session_state.user_email:
+        if not ss.user_email:
             st.warning("Please enter your email first.")
         else:
-            sub = check_user_subscription(st.session_state.user_email)
-            st.session_state.subscription_status = sub
-            if sub.get("has_subscription"):
-                remaining = sub.get('search_limit', 0) - sub.get('searches_used', 0)
-                st.success(f"✅ Active plan: {sub.get('plan', 'Unknown').title()} | Remaining: {remaining}")
-            else:
+            sub = check_user_subscription(ss.user_email)
+            ss.subscription_status = sub
+            # Remember which email was checked so a different address never shows its plan.
+            ss._sub_checked_email = ss.user_email if sub.get("has_subscription") else None
+            if not sub.get("has_subscription"):
                 st.info("No active subscription found.")
+    if ss.user_email and ss.get("_sub_checked_email") == ss.user_email:
+        # Re-read (cached) on every render so the count tracks usage and payments.
+        sub = check_user_subscription(ss.user_email)
+        if sub.get("has_subscription"):
+            remaining = sub.get('search_limit', 0) - sub.get('searches_used', 0)
+            st.success(f"✅ Active plan: {sub.get('plan', 'Unknown').title()} | Remaining: {remaining}")
 
     render_user_stats()
-    st.markdown('</div>', unsafe_allow_html=True)
 
 # ============== Router ==============
+_PAGES = {
+    "home": render_home_page,
+    "explainer": render_explainer_page,
+    "subscription": render_subscription_page,
+    "account": render_account_page,
+}
+
 def render_navigation_bar_and_route():
+    ss = st.session_state
     render_navigation()
 
     # Handle plan choice from popup via query param (?choose=basic)
     params = st.query_params
-    choose = (params.get("choose") or [None])[0]
-    if choose in {"basic", "plus", "pro"}:
-        st.session_state.current_page = "subscription"
-
-    page = st.session_state.get("current_page", "home")
-
-    if page == "home":
-        render_home_page()
-    elif page == "explainer":
-        render_explainer_page()
-    elif page == "subscription":
-        render_subscription_page()
-    elif page == "account":
-        render_account_page()
-    else:
-        render_home_page()
+    if params.get("choose") in ("basic", "plus", "pro"):
+        if ss.current_page != "subscription":
+            ss.current_page = "subscription"
+        # Consumed once; later reruns skip this check entirely.
+        del params["choose"]
+    # Stripe returns to the app root; show the result on the subscription page.
+    if params.get("success") == "true" or params.get("canceled") == "true":
+        ss.current_page = "subscription"
+
+    _PAGES.get(ss.current_page, render_home_page)()
 
     # Render popup if needed
-    render_subscription_popup()
+    if ss.show_subscription_popup:
+        render_subscription_popup()
 
 def main():
+    init_session_state()
     render_navigation_bar_and_route()
 
 if __name__ == "__main__":
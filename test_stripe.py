@@ -2,12 +2,19 @@
 import os
 import re
 import base64
+import hashlib
+import shutil
+import tempfile
 from collections import defaultdict
+from collections.abc import Mapping
 import json
-from datetime import datetime
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
 
+import pandas as pd
 import streamlit as st
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 import gridfs
 import fitz  # PyMuPDF
 import requests
@@ -31,39 +38,24 @@ OPENAI_API_KEY = st.secrets.get("OPENAI_API_KEY", os.getenv("OPENAI_API_KEY", ""
 BACKEND_URL = st.secrets.get("BACKEND_URL", os.getenv("BACKEND_URL", "http://localhost:5000"))
 
 # Updated Stripe Configuration
-STRIPE_SECRET_KEY = (
-    st.secrets.get("STRIPE_SECRET_KEY")
-    or (st.secrets.get("stripe", {}).get("SECRET_KEY") if isinstance(st.secrets.get("stripe", {}), dict) else None)
-    or os.getenv("STRIPE_SECRET_KEY", "")
-)
-STRIPE_PUBLISHABLE_KEY = (
-    st.secrets.get("STRIPE_PUBLISHABLE_KEY")
-    or (st.secrets.get("stripe", {}).get("PUBLISHABLE_KEY") if isinstance(st.secrets.get("stripe", {}), dict) else None)
-    or os.getenv("STRIPE_PUBLISHABLE_KEY", "")
-)
+# Read the optional [stripe] secrets section once instead of twice per setting.
+_stripe_secrets = st.secrets.get("stripe", {})
+if not isinstance(_stripe_secrets, Mapping):  # st.secrets sections are Mappings, not dicts
+    _stripe_secrets = {}
+
+def _stripe_setting(name: str, section_key: str) -> str:
+    """Top-level secret, then the [stripe] section, then the environment."""
+    return st.secrets.get(name) or _stripe_secrets.get(section_key) or os.getenv(name, "")
+
+STRIPE_SECRET_KEY = _stripe_setting("STRIPE_SECRET_KEY", "SECRET_KEY")
+STRIPE_PUBLISHABLE_KEY = _stripe_setting("STRIPE_PUBLISHABLE_KEY", "PUBLISHABLE_KEY")
 
 # Price IDs from secrets
-BASIC_PRICE_ID = (
-    st.secrets.get("BASIC_PRICE_ID")
-    or (st.secrets.get("stripe", {}).get("BASIC_PRICE_ID") if isinstance(st.secrets.get("stripe", {}), dict) else None)
-    or os.getenv("BASIC_PRICE_ID", "")
-)
-PLUS_PRICE_ID = (
-    st.secrets.get("PLUS_PRICE_ID")
-    or (st.secrets.get("stripe", {}).get("PLUS_PRICE_ID") if isinstance(st.secrets.get("stripe", {}), dict) else None)
-    or os.getenv("PLUS_PRICE_ID", "")
-)
-PRO_PRICE_ID = (
-    st.secrets.get("PRO_PRICE_ID")
-    or (st.secrets.get("stripe", {}).get("PRO_PRICE_ID") if isinstance(st.secrets.get("stripe", {}), dict) else None)
-    or os.getenv("PRO_PRICE_ID", "")
-)
+BASIC_PRICE_ID = _stripe_setting("BASIC_PRICE_ID", "BASIC_PRICE_ID")
+PLUS_PRICE_ID = _stripe_setting("PLUS_PRICE_ID", "PLUS_PRICE_ID")
+PRO_PRICE_ID = _stripe_setting("PRO_PRICE_ID", "PRO_PRICE_ID")
 
-STRIPE_WEBHOOK_SECRET = (
-    st.secrets.get("STRIPE_WEBHOOK_SECRET")
-    or (st.secrets.get("stripe", {}).get("WEBHOOK_SECRET") if isinstance(st.secrets.get("stripe", {}), dict) else None)
-    or os.getenv("STRIPE_WEBHOOK_SECRET", "")
-)
+STRIPE_WEBHOOK_SECRET = _stripe_setting("STRIPE_WEBHOOK_SECRET", "WEBHOOK_SECRET")
 
 if stripe and STRIPE_SECRET_KEY:
     stripe.api_key = STRIPE_SECRET_KEY
@@ -92,24 +84,80 @@ if _openai_mode is None:
 
 # ============== MongoDB Setup ==============
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/")
+
+# Wire compression for query/metadata traffic; zstd only when the optional
+# zstandard package is installed, zlib ships with Python.
+try:
+    import zstandard  # noqa: F401
+    _MONGO_COMPRESSORS = "zstd,zlib"
+except ImportError:
+    _MONGO_COMPRESSORS = "zlib"
+
+_log = logging.getLogger(__name__)
+
+# (collection, keys, create_index options)
+_MONGO_INDEXES = [
+    ("papers_metadata", "filename", {"unique": True}),
+    ("fs.files", "md5", {}),
+    ("papers_metadata", "exam_board", {}),
+    ("papers_metadata", [("uploaded_date", -1)], {}),  # newest-first admin lists
+    ("explanation_ratings", "question_id", {}),
+    ("subscriptions", "email", {"unique": True}),
+    ("subscriptions", "stripe_customer_id", {}),
+    ("subscriptions", [("status", 1), ("plan", 1)], {}),  # analytics counts
+    ("explanation_ratings", "rating", {}),
+    # Cached explanations expire after 30 days.
+    ("llm_cache", "ts", {"expireAfterSeconds": 30 * 86400}),
+]
+
+@st.cache_resource(show_spinner=False)
+def get_mongo():
+    """Create the pooled Mongo client and GridFS handles once per process; reruns reuse them."""
+    c = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000, maxPoolSize=50,
+                    compressors=_MONGO_COMPRESSORS)
+    c.admin.command("ping")  # raising here keeps a failed connect out of the cache
+    d = c["data"]
+    # Indexes on the lookup keys used below. Each is created on its own, so one
+    # failure (e.g. duplicate emails blocking the unique index) neither skips the
+    # rest nor disables Mongo.
+    for coll, keys, opts in _MONGO_INDEXES:
+        try:
+            d[coll].create_index(keys, **opts)
+        except Exception as e:
+            _log.warning("Could not create index %s on %s: %s", keys, coll, e)
+    # GridFSBucket shares the "fs" files; used for streamed uploads
+    return c, d, gridfs.GridFS(d), gridfs.GridFSBucket(d)
+
 try:
-    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=2000)
-    db = client["data"]
-    fs = gridfs.GridFS(db)
+    client, db, fs, fs_bucket = get_mongo()
     papers_collection = db["papers_metadata"]
     ratings_collection = db["explanation_ratings"]
     admin_users = db["admin_users"]
     subscriptions_collection = db["subscriptions"]  # Added for Stripe integration
+    llm_cache = db["llm_cache"]  # generated explanations, keyed by prompt hash
     _mongo_ok = True
-    client.server_info()  # quick ping
 except Exception:
     _mongo_ok = False
     fs = None
+    fs_bucket = None
 
 DATA_DIR = "data"
 TEMP_DIR = "temp_pdfs"
-os.makedirs(DATA_DIR, exist_ok=True)
-os.makedirs(TEMP_DIR, exist_ok=True)
+
+@st.cache_resource(show_spinner=False)
+def _boot() -> bool:
+    """Create the working directories once per process instead of on every rerun."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    return True
+
+_boot()
+
+# Session code letter -> months: display labels for the paper picker, and the
+# hyphenated names stored in paper metadata (matching the upload form options).
+_MONTH_MAP = {"m": "March", "s": "May–June", "w": "Oct–Nov"}
+_SESSION_MONTHS = {"m": "March", "s": "May-June", "w": "Oct-Nov"}
+_Q_NUM_RE = re.compile(r"\d+")
 
 # ============== Session State Initialization ==============
 def init_session_state():
@@ -128,30 +176,52 @@ def init_session_state():
 init_session_state()
 
 # ============== Upload Local PDFs to MongoDB ==============
+def _file_md5(path: str) -> str:
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
 def upload_pdfs_to_mongo(folder_path: str) -> int:
-    """Upload all PDFs in DATA_DIR to GridFS if not already present."""
+    """Upload all PDFs in DATA_DIR to GridFS if not already present (by name or content)."""
     if not _mongo_ok:
         return 0
     uploaded = 0
-    for filename in os.listdir(folder_path):
-        if not filename.lower().endswith(".pdf"):
+    local = [f for f in os.listdir(folder_path) if f.lower().endswith(".pdf")]
+    try:
+        existing = {
+            d["filename"]
+            for d in db["fs.files"].find({"filename": {"$in": local}}, {"filename": 1, "_id": 0})
+        }
+        # Hash only files whose name is new, to catch renamed copies of stored PDFs.
+        hashes = {
+            filename: _file_md5(os.path.join(folder_path, filename))
+            for filename in local if filename not in existing
+        }
+        existing_hashes = {
+            d["md5"]
+            for d in db["fs.files"].find({"md5": {"$in": list(hashes.values())}}, {"md5": 1, "_id": 0})
+        } if hashes else set()
+    except Exception as e:
+        st.warning(f"⚠️ Failed to list uploaded PDFs: {e}")
+        return 0
+    for filename, md5 in hashes.items():
+        if md5 in existing_hashes:
             continue
         try:
-            if fs.find_one({"filename": filename}):
-                continue
             file_path = os.path.join(folder_path, filename)
             with open(file_path, "rb") as f:
-                file_id = fs.put(f.read(), filename=filename)
-                # Store metadata
-                save_paper_metadata(filename, file_id)
-                uploaded += 1
+                # PyMongo 4 no longer computes GridFS md5, so store it ourselves.
+                file_id = fs.put(f, filename=filename, md5=md5)
+            # Store metadata
+            save_paper_metadata(filename, file_id)
+            existing_hashes.add(md5)
+            uploaded += 1
         except Exception as e:
             st.warning(f"⚠️ Failed to upload {filename}: {e}")
     return uploaded
 
-if _mongo_ok:
-    upload_pdfs_to_mongo(DATA_DIR)
-
 # ============== Content Management Functions ==============
 
 def save_paper_metadata(filename: str, file_id, exam_board=None, subject=None, year=None, session=None):
@@ -167,8 +237,7 @@ def save_paper_metadata(filename: str, file_id, exam_board=None, subject=None, y
             session_code = parts[1] if not session else session
             if len(session_code) >= 3:
                 year = f"20{session_code[1:3]}" if not year else year
-                month_map = {"m": "March", "s": "May-June", "w": "Oct-Nov"}
-                session = month_map.get(session_code[0].lower(), session_code) if not session else session
+                session = _SESSION_MONTHS.get(session_code[0].lower(), session_code) if not session else session
             subject = "Physics" if not subject else subject
     
     metadata = {
@@ -199,7 +268,8 @@ def get_paper_metadata(filename: str):
     if not _mongo_ok:
         return None
     try:
-        return papers_collection.find_one({"filename": filename})
+        # Older documents may still carry a stored text blob; never load it.
+        return papers_collection.find_one({"filename": filename}, {"text": 0})
     except Exception:
         return None
 
@@ -208,7 +278,7 @@ def update_paper_version(filename: str, new_file_id):
     if not _mongo_ok:
         return
     try:
-        current = papers_collection.find_one({"filename": filename})
+        current = papers_collection.find_one({"filename": filename}, {"version": 1})
         if current:
             new_version = current.get("version", 1) + 1
             papers_collection.update_one(
@@ -329,17 +399,18 @@ def handle_stripe_webhook(payload, signature):
     except stripe.error.SignatureVerificationError:
         return False
 
-    # Handle the event
+    return apply_webhook_event(event)
+
+def _webhook_update(event):
+    """Translate one Stripe event into (filter, update, upsert) for subscriptions, or None."""
     if event['type'] == 'checkout.session.completed':
         session = event['data']['object']
         # Update user subscription in your database
         customer_email = session.get('customer_email')
         plan = session.get('metadata', {}).get('plan', 'basic')
-        
-        # Add your database update logic here
-        if _mongo_ok and customer_email:
+        if customer_email:
             # Update user subscription status
-            subscriptions_collection.update_one(
+            return (
                 {"email": customer_email},
                 {
                     "$set": {
@@ -347,144 +418,188 @@ def handle_stripe_webhook(payload, signature):
                         "status": "active",
                         "stripe_session_id": session['id'],
                         "stripe_customer_id": session.get('customer'),
+                    },
+                    # Creation-only fields: a retried webhook must not reset usage.
+                    "$setOnInsert": {
                         "created_at": datetime.now(),
                         "searches_used": 0,
                         "last_reset": datetime.now()
                     }
                 },
-                upsert=True
+                True,  # upsert
             )
-        
+
     elif event['type'] == 'invoice.payment_succeeded':
         # Handle successful subscription renewal
         invoice = event['data']['object']
         customer_id = invoice.get('customer')
-        
-        if _mongo_ok and customer_id:
+        if customer_id:
             # Reset monthly usage
-            subscriptions_collection.update_one(
+            return (
                 {"stripe_customer_id": customer_id},
                 {
                     "$set": {
                         "searches_used": 0,
                         "last_reset": datetime.now()
                     }
-                }
+                },
+                False,  # upsert
             )
-    
+
     elif event['type'] == 'customer.subscription.deleted':
         # Handle subscription cancellation
         subscription = event['data']['object']
         customer_id = subscription.get('customer')
-        
-        if _mongo_ok and customer_id:
-            subscriptions_collection.update_one(
+        if customer_id:
+            return (
                 {"stripe_customer_id": customer_id},
                 {
                     "$set": {
                         "status": "cancelled",
                         "cancelled_at": datetime.now()
                     }
-                }
+                },
+                False,  # upsert
             )
-    
+    return None
+
+def apply_webhook_event(event) -> bool:
+    """Write the subscription change for one verified Stripe event."""
+    if not _mongo_ok:
+        return True
+    change = _webhook_update(event)
+    if change:
+        # Written before acknowledging: Stripe won't retry an event we already returned success for.
+        flt, update, upsert = change
+        subscriptions_collection.update_one(flt, update, upsert=upsert)
+        _load_subscription.clear()
     return True
 
+# Monthly search allowance per plan
+PLAN_LIMITS = {
+    'basic': 50,
+    'plus': 200,
+    'pro': 1000
+}
+
+_SUBSCRIPTION_FIELDS = {"plan": 1, "status": 1, "searches_used": 1, "stripe_customer_id": 1, "_id": 0}
+
+def _subscription_status(subscription) -> dict:
+    """Shape a subscriptions document into the status dict the pages use."""
+    if not subscription:
+        return {"has_subscription": False}
+
+    # Check if subscription is active
+    status = subscription.get('status', 'inactive')
+    if status != 'active':
+        return {"has_subscription": False}
+
+    plan = subscription.get('plan', 'basic')
+    return {
+        "has_subscription": True,
+        "plan": plan,
+        "search_limit": PLAN_LIMITS.get(plan, 50),
+        "searches_used": subscription.get('searches_used', 0),
+        "status": status,
+        "stripe_customer_id": subscription.get('stripe_customer_id')
+    }
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_subscription(email: str) -> dict:
+    """Cached per email, cleared on writes; raises on read errors so a failed read is never cached."""
+    return _subscription_status(subscriptions_collection.find_one({"email": email}, _SUBSCRIPTION_FIELDS))
+
 def check_user_subscription(email: str):
-    """Check subscription status from MongoDB and Stripe."""
+    """Check subscription status from MongoDB and Stripe"""
     if not _mongo_ok:
         return {"has_subscription": False}
     
     try:
-        # First check local database
-        subscription = subscriptions_collection.find_one({"email": email})
-        if not subscription:
-            return {"has_subscription": False}
-        
-        # Check if subscription is active
-        status = subscription.get('status', 'inactive')
-        if status != 'active':
-            return {"has_subscription": False}
-        
-        # Get plan limits
-        plan_limits = {
-            'basic': 50,
-            'plus': 200, 
-            'pro': 1000
-        }
-        
-        plan = subscription.get('plan', 'basic')
-        search_limit = plan_limits.get(plan, 50)
-        searches_used = subscription.get('searches_used', 0)
-        
-        return {
-            "has_subscription": True,
-            "plan": plan,
-            "search_limit": search_limit,
-            "searches_used": searches_used,
-            "status": status,
-            "stripe_customer_id": subscription.get('stripe_customer_id')
-        }
-        
+        return _load_subscription(email)
     except Exception as e:
         st.error(f"Error checking subscription: {e}")
         return {"has_subscription": False}
 
 def update_user_search_count(email: str):
-    """Increment search count for user"""
+    """
+    Count one search against an active subscription and return the updated status.
+    Increment and read happen in one atomic find_one_and_update; a search that
+    would exceed the plan limit is rolled back and reported with "limit_reached".
+    """
     if not _mongo_ok or not email:
-        return
+        return {"has_subscription": False}
     
     try:
-        subscriptions_collection.update_one(
-            {"email": email},
+        doc = subscriptions_collection.find_one_and_update(
+            {"email": email, "status": "active"},
             {
                 "$inc": {"searches_used": 1},
                 "$set": {"last_used": datetime.now()}
-            }
+            },
+            projection=_SUBSCRIPTION_FIELDS,
+            return_document=ReturnDocument.AFTER,
         )
+        _load_subscription.clear()
+        sub = _subscription_status(doc)
+        if sub["has_subscription"] and sub["searches_used"] > sub["search_limit"]:
+            subscriptions_collection.update_one({"email": email}, {"$inc": {"searches_used": -1}})
+            sub.update(searches_used=sub["search_limit"], limit_reached=True)
+        return sub
     except Exception as e:
         st.error(f"Failed to update search count: {e}")
+        return {"has_subscription": False}
 
 # ============== Enhanced Utility Functions ==============
 
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_qp_sessions():
+    """Cached session listing; raises on read errors so a failed read is never cached."""
+    session_dict = defaultdict(list)
+    # Filter and project server-side: only well-formed QP names, filename only.
+    # name format example: 9702_m24_qp_22.pdf
+    qp_filter = {"filename": {"$regex": "^[0-9]+_[mswMSW][0-9]{2}_qp_"}}
+    for file in db["fs.files"].find(qp_filter, {"filename": 1, "_id": 0}):
+        name = file["filename"]
+        session = name.split("_")[1]
+        year = "20" + session[1:3]
+        month = _MONTH_MAP[session[0].lower()]
+        session_dict[f"{year}-{month}"].append(name)
+    # newest first (string sort is fine due to YYYY- prefix)
+    return dict(sorted(session_dict.items(), key=lambda x: x[0], reverse=True))
+
 def get_qp_files_by_session():
     """Return {session_name: [qp_filenames...]} with newest sessions first."""
     if not _mongo_ok:
         return {}
-    session_dict = defaultdict(list)
     try:
-        for file in fs.find():
-            name = file.filename
-            if "_qp_" in name:
-                parts = name.split("_")
-                if len(parts) >= 3:
-                    # name format example: 9702_m24_qp_22.pdf
-                    code, session, _ = parts[:3]
-                    if len(session) >= 2:
-                        year = "20" + session[1:3]
-                        month_code = session[0].lower()
-                        month_map = {"m": "March", "s": "May–June", "w": "Oct–Nov"}
-                        month = month_map.get(month_code, session)
-                        session_name = f"{year}-{month}"
-                        session_dict[session_name].append(name)
+        return _load_qp_sessions()
     except Exception as e:
         st.error(f"Mongo read error: {e}")
         return {}
-    # newest first (string sort is fine due to YYYY- prefix)
-    return dict(sorted(session_dict.items(), key=lambda x: x[0], reverse=True))
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _load_papers_by_exam_board():
+    """Cached exam-board grouping; raises on read errors so a failed read is never cached."""
+    # One server-side grouping instead of distinct() plus a find() per board.
+    groups = papers_collection.aggregate([
+        {"$group": {
+            "_id": "$exam_board",
+            "papers": {"$push": {
+                "filename": "$filename",
+                "subject": "$subject",
+                "year": "$year",
+                "session": "$session",
+            }},
+        }},
+    ])
+    return {g["_id"]: g["papers"] for g in groups}
 
 def get_papers_by_exam_board():
     """Get papers organized by exam board"""
     if not _mongo_ok:
         return {}
     try:
-        exam_boards = papers_collection.distinct("exam_board")
-        result = {}
-        for board in exam_boards:
-            papers = list(papers_collection.find({"exam_board": board}))
-            result[board] = papers
-        return result
+        return _load_papers_by_exam_board()
     except Exception:
         return {}
 
@@ -492,25 +607,67 @@ def get_pdf_file(filename: str):
     if not _mongo_ok:
         return None
     try:
-        file = fs.find_one({"filename": filename})
-        if file:
-            path = os.path.join(TEMP_DIR, filename)
-            with open(path, "wb") as f:
-                f.write(file.read())
+        file = fs.get_last_version(filename=filename)
+        path = os.path.join(TEMP_DIR, filename)
+        # Reuse the local copy when it already matches the stored file: a re-uploaded
+        # version differs in size or is newer than the file on disk.
+        uploaded = file.upload_date.replace(tzinfo=timezone.utc).timestamp()
+        if (os.path.exists(path) and os.path.getsize(path) == file.length
+                and os.path.getmtime(path) >= uploaded):
             return path
+        # Copy in 1 MiB chunks into a per-call temp file, then rename, so readers
+        # never see a partial PDF and concurrent downloads don't share a file.
+        with tempfile.NamedTemporaryFile("wb", dir=TEMP_DIR, suffix=".part", delete=False) as f:
+            tmp_path = f.name
+            try:
+                shutil.copyfileobj(file, f, length=1 << 20)
+            except BaseException:
+                f.close()
+                os.unlink(tmp_path)
+                raise
+        os.replace(tmp_path, path)
+        return path
+    except gridfs.errors.NoFile:
+        pass
     except Exception as e:
         st.error(f"Failed to fetch {filename}: {e}")
     return None
 
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def extract_text_cached(path: str, mtime: float) -> str:
+    """Extract plain text from a PDF; cached on (path, mtime) so reruns skip PyMuPDF.
+
+    Raises on failure so a transient error is never cached.
+    """
+    parts = []
+    with fitz.open(path) as doc:
+        for page in doc:
+            parts.append(page.get_text("text"))
+    return "".join(parts)
+
 def extract_text(path: str) -> str:
-    text = ""
     try:
-        with fitz.open(path) as doc:
-            for page in doc:
-                text += page.get_text()
+        return extract_text_cached(path, _mtime(path))
     except Exception as e:
         st.error(f"PDF text extraction failed ({os.path.basename(path)}): {e}")
-    return text
+    return ""
+
+# Next token: start of another question number with optional chained parts
+# Examples: 3, 3(a), 3(a)(ii), 12(c)(iv)
+# The token must end at whitespace: a trailing \b cannot match after ")", which cut
+# "3(a)" down to "3", and it let decimals like "3.5" pass as tokens.
+_NEXT_TOKEN_RE = re.compile(r"^\s*\d+(\([a-z]\))*(\([ivxl]+\))*(?=\s|$)", re.M)
+
+@lru_cache(maxsize=256)
+def _compile_block_pattern(q: str):
+    """Compile (once per question token) the regex matching the question's first line."""
+    return re.compile(rf"(?m)^\s*{re.escape(q.strip())}[^\n]*\n")
 
 def _extract_block(text: str, q: str) -> str:
     """
@@ -521,26 +678,71 @@ def _extract_block(text: str, q: str) -> str:
     if not text.strip():
         return "❌ Not found (empty text)."
 
-    escaped_q = re.escape(q.strip())
-    # Next token: start of another question number with optional chained parts
-    # Examples: 3, 3(a), 3(a)(ii), 12(c)(iv)
-    next_token = r"^\s*\d+(\([a-z]\))*(\([ivxl]+\))*\b"
-
-    # Multiline + dotall so ^/$ apply line-wise
-    pattern = rf"(?ms)^\s*{escaped_q}[^\n]*\n(?:.*?\n)*?(?={next_token}|\Z)"
-    m = re.search(pattern, text)
-    return m.group(0).strip() if m else "❌ Not found."
+    # Find the question's first line, then scan forward to the next token.
+    m = _compile_block_pattern(q).search(text)
+    if not m:
+        return "❌ Not found."
+    nxt = _NEXT_TOKEN_RE.search(text, m.end())
+    return text[m.start():nxt.start() if nxt else len(text)].strip()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _index_questions(path: str, mtime: float):
+    """Map each full question token ("3", "3(a)", "3(b)(ii)") in the PDF's text to its
+    (start, end) span, in one pass. Cached on (path, mtime) so lookups never hash the text.
+    Returns (index, text length)."""
+    text = extract_text_cached(path, mtime)
+    starts = [(m.group(0).strip(), m.start()) for m in _NEXT_TOKEN_RE.finditer(text)]
+    index = {}
+    for i, (qid, start) in enumerate(starts):
+        end = starts[i + 1][1] if i + 1 < len(starts) else len(text)
+        index.setdefault(qid, (start, end))  # first occurrence wins, as with re.search
+    return index, len(text)
+
+def _lookup_block(text: str, q: str, path: str = None) -> str:
+    # `text` is extract_text(path) when a path is given; the length check guards a mismatch.
+    if path:
+        try:
+            index, length = _index_questions(path, _mtime(path))
+        except Exception:
+            index, length = {}, -1  # extraction failed; the scan below still works on `text`
+        span = index.get(q.strip())
+        if span and length == len(text):
+            return text[span[0]:span[1]].strip()
+    # No path, or a token the index doesn't key on (e.g. written inline): scan.
+    return _extract_block(text, q)
+
+def extract_specific_question(text: str, question_number: str, path: str = None) -> str:
+    return _lookup_block(text, question_number, path)
+
+def extract_specific_answer(text: str, question_number: str, path: str = None) -> str:
+    return _lookup_block(text, question_number, path)
+
+def _llm_cache_get(key: str):
+    """Previously generated explanation for `key`, or None."""
+    if not _mongo_ok:
+        return None
+    try:
+        hit = llm_cache.find_one({"_id": key}, {"text": 1})
+        return hit["text"] if hit else None
+    except Exception:
+        return None
 
-def extract_specific_question(text: str, question_number: str) -> str:
-    return _extract_block(text, question_number)
+def _llm_cache_put(key: str, text: str):
+    if not _mongo_ok or not text.strip():
+        return
+    try:
+        llm_cache.replace_one({"_id": key}, {"text": text, "ts": datetime.now()}, upsert=True)
+    except Exception:
+        pass  # caching is best-effort; the user already has the answer
 
-def extract_specific_answer(text: str, question_number: str) -> str:
-    return _extract_block(text, question_number)
+def ask_llm_enhanced_stream(qp_text: str, ms_text: str, question_number: str,
+                            qp_path: str = None, ms_path: str = None):
+    """Enhanced AI explanation, yielded chunk-by-chunk for st.write_stream.
 
-def ask_llm_enhanced(qp_text: str, ms_text: str, question_number: str) -> str:
-    """Enhanced AI explanation with step-by-step breakdown"""
-    question = extract_specific_question(qp_text, question_number)
-    answer = extract_specific_answer(ms_text, question_number)
+    Pass the PDF paths the texts came from to use the cached per-file question index.
+    """
+    question = extract_specific_question(qp_text, question_number, qp_path)
+    answer = extract_specific_answer(ms_text, question_number, ms_path)
 
     prompt = f"""You are a helpful A-Level Physics tutor.
 
@@ -578,32 +780,57 @@ Format your response as:
 Now explain the answer step-by-step following the format above, without adding anything extra.
 """
 
+    model = "gpt-4o-mini" if _openai_mode == "new" else "gpt-4"
+    # The prompt embeds the question and answer text, so its hash covers paper, question and prompt version.
+    cache_key = hashlib.sha256(f"{model}|{prompt}".encode("utf-8")).hexdigest()
+    cached = _llm_cache_get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
     try:
         if _openai_mode == "new" and _openai_client:
-            resp = _openai_client.chat.completions.create(
-                model="gpt-4o-mini",
+            stream = _openai_client.chat.completions.create(
+                model=model,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.2,
                 max_tokens=1200,
+                stream=True,
             )
-            return (resp.choices[0].message.content or "").strip()
+            for chunk in stream:
+                if chunk.choices:
+                    text = chunk.choices[0].delta.content or ""
+                    parts.append(text)
+                    yield text
         elif _openai_mode == "old":
             import openai  # type: ignore
             resp = openai.ChatCompletion.create(
-                model="gpt-4",
+                model=model,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.2,
                 max_tokens=1200,
             )
-            return (resp.choices[0].message.content or "").strip()
+            text = resp.choices[0].message.content or ""
+            parts.append(text)
+            yield text
         else:
-            return "❌ AI Error: OpenAI client not configured. Add your OPENAI_API_KEY to .streamlit/secrets.toml."
+            yield "❌ AI Error: OpenAI client not configured. Add your OPENAI_API_KEY to .streamlit/secrets.toml."
+            return
     except Exception as e:
-        return f"❌ AI Error: {e}"
+        yield f"❌ AI Error: {e}"
+        return
+    _llm_cache_put(cache_key, "".join(parts))
+
+def ask_llm_enhanced(qp_text: str, ms_text: str, question_number: str,
+                     qp_path: str = None, ms_path: str = None) -> str:
+    """Enhanced AI explanation with step-by-step breakdown, as one string"""
+    return "".join(ask_llm_enhanced_stream(qp_text, ms_text, question_number, qp_path, ms_path)).strip()
 
-def ask_llm(qp_text: str, ms_text: str, question_number: str) -> str:
+def ask_llm(qp_text: str, ms_text: str, question_number: str,
+            qp_path: str = None, ms_path: str = None) -> str:
     """Original function for backward compatibility"""
-    return ask_llm_enhanced(qp_text, ms_text, question_number)
+    return ask_llm_enhanced(qp_text, ms_text, question_number, qp_path, ms_path)
 
 def get_related_questions(current_question: str, current_paper: str):
     """Get related questions from the same topic"""
@@ -611,9 +838,9 @@ def get_related_questions(current_question: str, current_paper: str):
     related = []
     try:
         # Extract question number pattern
-        q_num = re.findall(r'\d+', current_question)
+        q_num = _Q_NUM_RE.search(current_question)
         if q_num:
-            base_num = int(q_num[0])
+            base_num = int(q_num.group())
             # Suggest adjacent questions
             for i in range(max(1, base_num-2), min(base_num+3, 20)):
                 if i != base_num:
@@ -622,11 +849,15 @@ def get_related_questions(current_question: str, current_paper: str):
         pass
     return related[:3]  # Return max 3 suggestions
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def _pdf_b64(path: str, mtime: float) -> str:
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
 def display_pdf_inline(path: str, zoom_percent: int = 100, height_px: int = 800) -> str:
     """Embed a PDF inline. Width is responsive; zoom affects CSS scale."""
     try:
-        with open(path, "rb") as f:
-            base64_pdf = base64.b64encode(f.read()).decode("utf-8")
+        base64_pdf = _pdf_b64(path, os.path.getmtime(path))
         scale = max(50, min(200, int(zoom_percent))) / 100.0
         return f"""
         <div style="width:100%; border:1px solid #e9ecef; border-radius:8px; overflow:auto">
@@ -639,18 +870,30 @@ def display_pdf_inline(path: str, zoom_percent: int = 100, height_px: int = 800)
     except Exception:
         return "<div class='error-alert'>❌ Unable to render PDF inline.</div>"
 
-def file_info(path: str):
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def _file_info_cached(path: str, mtime: float):
     try:
         with fitz.open(path) as doc:
             return len(doc), os.path.getsize(path)
     except Exception:
         return 0, 0
 
+def file_info(path: str):
+    return _file_info_cached(path, _mtime(path))
+
+@st.cache_resource(show_spinner=False)
+def _bootstrap_uploads() -> int:
+    """Sync DATA_DIR into GridFS once per process rather than on every rerun."""
+    return upload_pdfs_to_mongo(DATA_DIR)
+
+# Runs once every helper the upload uses (metadata) is defined.
+if _mongo_ok:
+    _bootstrap_uploads()
+
 # ============== Enhanced CSS Styling ==============
-def load_css():
-    st.markdown(
-        """
-    <style>
+# Static, so built once at import rather than inside load_css on every call.
+# Critical: layout, header, nav, cards, buttons, alerts (what the first paint needs).
+_CRITICAL_CSS = """
     /* Enhanced animations and transitions */
     @keyframes fadeIn {
         from { opacity: 0; transform: translateY(20px); }
@@ -696,14 +939,30 @@ def load_css():
         color: white; 
         animation: fadeIn 1s ease-out;
         box-shadow: 0 10px 30px rgba(102, 126, 234, 0.3);
-        background-size: 200% 200%;
+        position: relative;
+        overflow: hidden;
+        isolation: isolate;
+    }
+    
+    /* Shifting gradient on a double-width layer moved with transform, which
+       the compositor handles; animating background-position repaints every frame. */
+    .app-header::before {
+        content: '';
+        position: absolute;
+        top: 0;
+        left: 0;
+        bottom: 0;
+        width: 200%;
+        z-index: -1;
+        background: linear-gradient(135deg, #667eea 0%, #764ba2 25%, #667eea 50%, #764ba2 75%, #667eea 100%);
         animation: gradient-shift 3s ease infinite;
+        will-change: transform;
     }
     
     @keyframes gradient-shift {
-        0% { background-position: 0% 50%; }
-        50% { background-position: 100% 50%; }
-        100% { background-position: 0% 50%; }
+        0% { transform: translateX(0); }
+        50% { transform: translateX(-50%); }
+        100% { transform: translateX(0); }
     }
     
     .app-header h1 { 
@@ -734,16 +993,51 @@ def load_css():
         text-align: center; 
         flex: 1; 
         border-left: 4px solid #667eea;
-        transition: all 0.3s ease;
         cursor: pointer;
+        --lift: translateY(-5px);
+        --hover-shadow: 0 10px 30px rgba(102, 126, 234, 0.2);
     }
     
     .stat-card:hover {
-        transform: translateY(-5px);
-        box-shadow: 0 10px 30px rgba(102, 126, 234, 0.2);
         border-left-width: 8px;
     }
     
+    /* Shared hover lift: only transform moves, and the deeper shadow is a
+       pre-laid ::after whose opacity fades in, so hovering never repaints
+       a box-shadow. Each card sets its own --lift and --hover-shadow. */
+    .stat-card, .plan-card, .admin-card, .popup-plan-card,
+    .related-question-btn, .concept-tag {
+        position: relative;
+        transition: transform 0.3s ease, background-color 0.3s ease,
+                    color 0.3s ease, border-color 0.3s ease;
+    }
+    
+    .stat-card, .plan-card, .admin-card, .popup-plan-card {
+        will-change: transform;
+    }
+    
+    .stat-card:hover, .plan-card:hover, .admin-card:hover, .popup-plan-card:hover,
+    .related-question-btn:hover, .concept-tag:hover {
+        transform: var(--lift);
+    }
+    
+    .stat-card::after, .admin-card::after, .popup-plan-card::after,
+    .related-question-btn::after {
+        content: '';
+        position: absolute;
+        inset: 0;
+        border-radius: inherit;
+        box-shadow: var(--hover-shadow);
+        opacity: 0;
+        transition: opacity 0.3s ease;
+        pointer-events: none;
+    }
+    
+    .stat-card:hover::after, .admin-card:hover::after, .popup-plan-card:hover::after,
+    .related-question-btn:hover::after {
+        opacity: 1;
+    }
+    
     .stat-number { 
         font-size: 2rem; 
         font-weight: bold; 
@@ -796,10 +1090,11 @@ def load_css():
         border-radius: 20px; 
         padding: 2rem; 
         text-align: center; 
-        transition: all 0.4s cubic-bezier(0.175, 0.885, 0.32, 1.275); 
-        position: relative; 
+        transition: transform 0.4s cubic-bezier(0.175, 0.885, 0.32, 1.275),
+                    border-color 0.4s ease, box-shadow 0.4s ease;
         overflow: hidden;
         cursor: pointer;
+        --lift: translateY(-10px) scale(1.02);
     }
     
     .plan-card::before {
@@ -817,8 +1112,8 @@ def load_css():
         left: 100%;
     }
     
+    /* overflow:hidden (for the shine sweep) would clip an ::after shadow */
     .plan-card:hover { 
-        transform: translateY(-10px) scale(1.02); 
         box-shadow: 0 20px 40px rgba(0,0,0,0.15); 
         border-color: #667eea; 
     }
@@ -939,52 +1234,54 @@ def load_css():
         content: '';
         position: absolute;
         top: 0;
-        left: 0;
+        left: -30px; /* one stripe period of slack for the slide */
         bottom: 0;
         right: 0;
         background-image: linear-gradient(45deg, rgba(255,255,255,.2) 25%, transparent 25%, transparent 50%, rgba(255,255,255,.2) 50%, rgba(255,255,255,.2) 75%, transparent 75%, transparent);
         background-size: 30px 30px;
         animation: move 2s linear infinite;
+        will-change: transform;
     }
     
+    /* The stripes repeat every 30px, so sliding one period loops seamlessly. */
     @keyframes move {
-        0% { background-position: 0 0; }
-        100% { background-position: 30px 30px; }
+        0% { transform: translateX(0); }
+        100% { transform: translateX(30px); }
     }
     
-    .success-alert { 
-        background: linear-gradient(135deg, #d4edda 0%, #c3e6cb 100%); 
-        border: 1px solid #28a745; 
-        color: #155724; 
-        padding: 1.5rem; 
-        border-radius: 12px; 
+    /* Alerts share one rule; each variant only sets its colours. */
+    .success-alert, .warning-alert, .error-alert {
+        background: linear-gradient(135deg, var(--alert-from) 0%, var(--alert-to) 100%);
+        border: 1px solid var(--alert-accent);
+        color: var(--alert-text);
+        padding: 1.5rem;
+        border-radius: 12px;
         margin: 1rem 0;
         animation: fadeIn 0.5s ease-out;
-        box-shadow: 0 5px 15px rgba(40, 167, 69, 0.2);
+        box-shadow: 0 5px 15px var(--alert-shadow);
     }
     
-    .warning-alert { 
-        background: linear-gradient(135deg, #fff3cd 0%, #ffeaa7 100%); 
-        border: 1px solid #ffc107; 
-        color: #856404; 
-        padding: 1.5rem; 
-        border-radius: 12px; 
-        margin: 1rem 0;
-        animation: fadeIn 0.5s ease-out;
-        box-shadow: 0 5px 15px rgba(255, 193, 7, 0.2);
+    .success-alert {
+        --alert-from: #d4edda; --alert-to: #c3e6cb; --alert-accent: #28a745;
+        --alert-text: #155724; --alert-shadow: rgba(40, 167, 69, 0.2);
     }
     
-    .error-alert { 
-        background: linear-gradient(135deg, #f8d7da 0%, #f5c6cb 100%); 
-        border: 1px solid #dc3545; 
-        color: #721c24; 
-        padding: 1.5rem; 
-        border-radius: 12px; 
-        margin: 1rem 0;
-        animation: fadeIn 0.5s ease-out;
-        box-shadow: 0 5px 15px rgba(220, 53, 69, 0.2);
+    .warning-alert {
+        --alert-from: #fff3cd; --alert-to: #ffeaa7; --alert-accent: #ffc107;
+        --alert-text: #856404; --alert-shadow: rgba(255, 193, 7, 0.2);
+    }
+    
+    .error-alert {
+        --alert-from: #f8d7da; --alert-to: #f5c6cb; --alert-accent: #dc3545;
+        --alert-text: #721c24; --alert-shadow: rgba(220, 53, 69, 0.2);
     }
 
+    """
+
+# Deferred: popup, admin, rating, media queries and other late-use styles,
+# sent at the end of the run so they don't hold up the page content.
+# Order is preserved, so the cascade is unchanged.
+_DEFERRED_CSS = """
     /* Enhanced popup styles */
     .popup-overlay { 
         position: fixed; 
@@ -1012,6 +1309,7 @@ def load_css():
         box-shadow: 0 25px 50px rgba(0,0,0,0.3); 
         animation: popupSlide 0.5s cubic-bezier(0.175, 0.885, 0.32, 1.275);
         border: 1px solid rgba(255, 255, 255, 0.2);
+        will-change: transform;
     }
     
     @keyframes popupSlide { 
@@ -1085,12 +1383,8 @@ def load_css():
         margin: 1rem 0;
         box-shadow: 0 5px 20px rgba(0,0,0,0.1);
         border-left: 5px solid #ff6b6b;
-        transition: all 0.3s ease;
-    }
-    
-    .admin-card:hover {
-        transform: translateX(5px);
-        box-shadow: 0 10px 30px rgba(255, 107, 107, 0.2);
+        --lift: translateX(5px);
+        --hover-shadow: 0 10px 30px rgba(255, 107, 107, 0.2);
     }
     
     /* Rating System */
@@ -1134,20 +1428,14 @@ def load_css():
         animation: fadeIn 0.5s ease-out;
     }
     
-    .difficulty-easy {
-        background: linear-gradient(135deg, #2ecc71, #27ae60);
-        color: white;
-    }
-    
-    .difficulty-medium {
-        background: linear-gradient(135deg, #f39c12, #e67e22);
+    .difficulty-easy, .difficulty-medium, .difficulty-hard {
+        background: linear-gradient(135deg, var(--badge-from), var(--badge-to));
         color: white;
     }
     
-    .difficulty-hard {
-        background: linear-gradient(135deg, #e74c3c, #c0392b);
-        color: white;
-    }
+    .difficulty-easy { --badge-from: #2ecc71; --badge-to: #27ae60; }
+    .difficulty-medium { --badge-from: #f39c12; --badge-to: #e67e22; }
+    .difficulty-hard { --badge-from: #e74c3c; --badge-to: #c0392b; }
     
     /* Enhanced mobile responsiveness */
     @media (max-width: 768px) {
@@ -1185,6 +1473,7 @@ def load_css():
         border-top-color: #667eea;
         animation: spin 1s ease-in-out infinite;
         margin-right: 10px;
+        will-change: transform;
     }
     
     @keyframes spin {
@@ -1224,6 +1513,9 @@ def load_css():
             animation-iteration-count: 1 !important;
             transition-duration: 0.01ms !important;
         }
+        .app-header::before, .progress-bar::after, .loading-spinner {
+            will-change: auto;
+        }
     }
     
     /* Color scheme for dark mode preference */
@@ -1272,13 +1564,12 @@ def load_css():
         margin: 0.2rem;
         font-size: 0.9rem;
         border: 1px solid #dee2e6;
-        transition: all 0.3s ease;
+        --lift: translateY(-2px);
     }
     
     .concept-tag:hover {
         background: #667eea;
         color: white;
-        transform: translateY(-2px);
     }
     
     /* Related questions */
@@ -1298,15 +1589,14 @@ def load_css():
         border-radius: 25px;
         margin: 0.5rem;
         cursor: pointer;
-        transition: all 0.3s ease;
         font-weight: 600;
+        --lift: translateY(-2px);
+        --hover-shadow: 0 5px 15px rgba(102, 126, 234, 0.3);
     }
     
     .related-question-btn:hover {
         background: #667eea;
         color: white;
-        transform: translateY(-2px);
-        box-shadow: 0 5px 15px rgba(102, 126, 234, 0.3);
     }
     
     /* Popup plans specific styling */
@@ -1323,13 +1613,12 @@ def load_css():
         border-radius: 15px;
         padding: 1.5rem;
         text-align: center;
-        transition: all 0.3s ease;
         cursor: pointer;
+        --lift: translateY(-5px);
+        --hover-shadow: 0 15px 35px rgba(0,0,0,0.1);
     }
     
     .popup-plan-card:hover {
-        transform: translateY(-5px);
-        box-shadow: 0 15px 35px rgba(0,0,0,0.1);
         border-color: #667eea;
     }
     
@@ -1337,10 +1626,29 @@ def load_css():
         border-color: #28a745;
         background: linear-gradient(135deg, #ffffff 0%, #f8fff9 100%);
     }
-    </style>
-    """,
-        unsafe_allow_html=True,
-    )
+    """
+
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_WS_RE = re.compile(r"\s+")
+# Not ':' on its left: "a :hover" (descendant) differs from "a:hover".
+_CSS_PUNCT_RE = re.compile(r"\s*([{};,>])\s*|:\s+")
+
+def _minify_css(css: str) -> str:
+    """Drop comments and collapse whitespace around punctuation."""
+    css = _CSS_WS_RE.sub(" ", _CSS_COMMENT_RE.sub("", css))
+    return _CSS_PUNCT_RE.sub(lambda m: m.group(1) or ":", css).strip()
+
+_CSS_BLOB = "<style>" + _minify_css(_CRITICAL_CSS) + "</style>"
+_DEFERRED_CSS_BLOB = "<style>" + _minify_css(_DEFERRED_CSS) + "</style>"
+
+def load_css():
+    # Re-emitted on every rerun on purpose: Streamlit drops any element a run
+    # doesn't send, so a once-per-session guard would unstyle the app.
+    st.markdown(_CSS_BLOB, unsafe_allow_html=True)
+
+def load_deferred_css():
+    """Emit the non-critical styles; call last, after the page content."""
+    st.markdown(_DEFERRED_CSS_BLOB, unsafe_allow_html=True)
 
 load_css()
 
@@ -1378,20 +1686,9 @@ def render_admin_panel():
             st.rerun()
     st.markdown('</div>', unsafe_allow_html=True)
     
-    # Admin tabs
-    tab1, tab2, tab3, tab4 = st.tabs(["Upload Papers", "Manage Content", "Analytics", "Settings"])
-    
-    with tab1:
-        render_upload_interface()
-    
-    with tab2:
-        render_content_management()
-    
-    with tab3:
-        render_admin_analytics()
-    
-    with tab4:
-        render_admin_settings()
+    # Admin sections: unlike st.tabs, only the selected section's body runs.
+    section = st.radio("Admin section", list(_ADMIN_SECTIONS), horizontal=True, key="admin_section")
+    _ADMIN_SECTIONS[section]()
 def render_admin_settings():
     """Render the admin settings interface"""
     st.markdown('<div class="admin-card">', unsafe_allow_html=True)
@@ -1437,16 +1734,32 @@ def render_upload_interface():
         if st.button("Upload Papers", key="upload_btn"):
             with st.spinner("Uploading papers..."):
                 success_count = 0
+                # One query decides new-vs-version for the whole batch.
+                names = [f.name for f in uploaded_files]
+                try:
+                    existing = {
+                        d["filename"]
+                        for d in db["fs.files"].find({"filename": {"$in": names}}, {"filename": 1, "_id": 0})
+                    }
+                except Exception as e:
+                    st.error(f"Failed to check existing papers: {e}")
+                    uploaded_files = []
                 for uploaded_file in uploaded_files:
                     try:
+                        # Upload in 1 MiB GridFS chunks straight from the in-memory file.
+                        uploaded_file.seek(0)
                         # Check if file already exists
-                        if fs.find_one({"filename": uploaded_file.name}):
+                        if uploaded_file.name in existing:
                             # Update version
-                            file_id = fs.put(uploaded_file.read(), filename=uploaded_file.name)
+                            file_id = fs_bucket.upload_from_stream(
+                                uploaded_file.name, uploaded_file, chunk_size_bytes=1 << 20
+                            )
                             update_paper_version(uploaded_file.name, file_id)
                         else:
                             # New upload
-                            file_id = fs.put(uploaded_file.read(), filename=uploaded_file.name)
+                            file_id = fs_bucket.upload_from_stream(
+                                uploaded_file.name, uploaded_file, chunk_size_bytes=1 << 20
+                            )
                             save_paper_metadata(
                                 uploaded_file.name, file_id, exam_board, 
                                 subject, year, session
@@ -1460,124 +1773,194 @@ def render_upload_interface():
                                     "moderated": True
                                 }}
                             )
+                            existing.add(uploaded_file.name)
                         success_count += 1
                     except Exception as e:
                         st.error(f"Failed to upload {uploaded_file.name}: {e}")
                 
                 if success_count > 0:
+                    # New files must show up in the cached listings straight away.
+                    _load_qp_sessions.clear()
+                    _load_papers_by_exam_board.clear()
+                    _load_recent_papers.clear()
                     st.success(f"Successfully uploaded {success_count} papers!")
                     st.balloons()
     
     st.markdown('</div>', unsafe_allow_html=True)
 
+_RECENT_PAPER_FIELDS = {
+    "filename": 1, "version": 1, "exam_board": 1, "subject": 1, "year": 1, "session": 1,
+    "difficulty": 1, "moderated": 1, "topics": 1, "uploaded_date": 1, "file_id": 1,
+}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_recent_papers(limit: int = 50):
+    """Newest papers with just the fields the content manager shows; cleared on edits."""
+    papers = list(papers_collection.find({}, _RECENT_PAPER_FIELDS).sort("uploaded_date", -1).limit(limit))
+    # Display strings are formatted once here instead of on every render.
+    for paper in papers:
+        uploaded = paper.get("uploaded_date")
+        paper["_date_str"] = uploaded.strftime("%Y-%m-%d") if uploaded else "Unknown"
+        paper["_topics_str"] = ", ".join(paper.get("topics", []))
+    return papers
+
 def render_content_management():
     """Content management interface"""
     st.markdown('<div class="admin-card">', unsafe_allow_html=True)
     st.markdown("#### Manage Existing Papers")
     
     if _mongo_ok:
-        papers = list(papers_collection.find().sort("uploaded_date", -1).limit(50))
+        papers = _load_recent_papers()
         
         if papers:
-            for paper in papers:
-                with st.expander(f"{paper['filename']} (v{paper.get('version', 1)})"):
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        st.write(f"**Exam Board:** {paper.get('exam_board', 'Unknown')}")
-                        st.write(f"**Subject:** {paper.get('subject', 'Unknown')}")
-                        st.write(f"**Year:** {paper.get('year', 'Unknown')}")
-                    
-                    with col2:
-                        st.write(f"**Session:** {paper.get('session', 'Unknown')}")
-                        st.write(f"**Difficulty:** {paper.get('difficulty', 'Medium')}")
-                        st.write(f"**Moderated:** {'✅' if paper.get('moderated') else '❌'}")
-                    
-                    with col3:
-                        st.write(f"**Topics:** {', '.join(paper.get('topics', []))}")
-                        st.write(f"**Uploaded:** {paper.get('uploaded_date', '').strftime('%Y-%m-%d') if paper.get('uploaded_date') else 'Unknown'}")
-                    
-                    # Quick actions
-                    action_col1, action_col2, action_col3 = st.columns(3)
-                    with action_col1:
-                        if st.button(f"Delete", key=f"delete_{paper['filename']}"):
-                            try:
-                                fs.delete(paper['file_id'])
-                                papers_collection.delete_one({"filename": paper['filename']})
-                                st.success("Paper deleted!")
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"Delete failed: {e}")
-                    
-                    with action_col2:
-                        new_moderation = st.checkbox(
-                            "Moderated", 
-                            value=paper.get('moderated', True),
-                            key=f"mod_{paper['filename']}"
-                        )
-                        if new_moderation != paper.get('moderated'):
-                            papers_collection.update_one(
-                                {"filename": paper['filename']},
-                                {"$set": {"moderated": new_moderation}}
-                            )
-                    
-                    with action_col3:
-                        if st.button(f"View Stats", key=f"stats_{paper['filename']}"):
-                            st.info("Stats feature coming soon!")
+            df = pd.DataFrame([{
+                "filename": p['filename'],
+                "version": p.get('version', 1),
+                "exam_board": p.get('exam_board', 'Unknown'),
+                "subject": p.get('subject', 'Unknown'),
+                "year": str(p.get('year') or 'Unknown'),
+                "session": p.get('session', 'Unknown'),
+                "difficulty": p.get('difficulty', 'Medium'),
+                "moderated": bool(p.get('moderated', True)),
+                "topics": p['_topics_str'],
+                "uploaded": p['_date_str'],
+                "delete": False,
+            } for p in papers])
+            
+            # The editor keeps edits by row position; if the rows changed underneath it
+            # (TTL refresh, new upload) drop them rather than apply them to other papers.
+            rows = tuple(df["filename"])
+            if st.session_state.get("_papers_editor_rows") != rows:
+                st.session_state.pop("papers_editor", None)
+                st.session_state["_papers_editor_rows"] = rows
+            
+            # One grid widget for the whole list; only the two flags are editable
+            edited = st.data_editor(
+                df,
+                column_config={
+                    "moderated": st.column_config.CheckboxColumn("Moderated"),
+                    "delete": st.column_config.CheckboxColumn("Delete?"),
+                },
+                disabled=[c for c in df.columns if c not in ("moderated", "delete")],
+                hide_index=True,
+                use_container_width=True,
+                key="papers_editor",
+            )
+            
+            # Compare per filename and only write on an explicit save, then reset the editor.
+            original = dict(zip(df["filename"], df["moderated"]))
+            changes = {
+                f: bool(v) for f, v in zip(edited["filename"], edited["moderated"])
+                if original.get(f) != v
+            }
+            if changes and st.button(f"Save moderation ({len(changes)} change(s))"):
+                try:
+                    # Write every toggled flag in one round trip
+                    papers_collection.bulk_write([
+                        UpdateOne({"filename": f}, {"$set": {"moderated": v}})
+                        for f, v in changes.items()
+                    ], ordered=False)
+                    _load_recent_papers.clear()
+                    st.session_state.pop("papers_editor", None)
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Failed to update moderation: {e}")
+            
+            to_delete = edited.loc[edited["delete"], "filename"].tolist()
+            if to_delete and st.button(f"Delete {len(to_delete)} selected paper(s)", type="primary"):
+                file_ids = {p['filename']: p['file_id'] for p in papers}
+                try:
+                    for name in to_delete:
+                        fs.delete(file_ids[name])
+                    papers_collection.delete_many({"filename": {"$in": to_delete}})
+                    _load_recent_papers.clear()
+                    # Row edits are stored by position; drop them once rows go away
+                    st.session_state.pop("papers_editor", None)
+                    st.success("Paper(s) deleted!")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Delete failed: {e}")
         else:
             st.info("No papers found in database.")
     
     st.markdown('</div>', unsafe_allow_html=True)
 
+@st.cache_data(ttl=30, show_spinner=False)
+def _load_admin_stats() -> dict:
+    """Dashboard metrics in three aggregations (one per collection) instead of seven queries."""
+    papers = next(papers_collection.aggregate([{"$facet": {
+        "total": [{"$count": "n"}],
+        "by_board": [
+            {"$group": {"_id": "$exam_board", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}
+        ],
+        "recent": [
+            {"$sort": {"uploaded_date": -1}},
+            {"$limit": 5},
+            {"$project": {"_id": 0, "filename": 1, "uploaded_date": 1}}
+        ],
+    }}]))
+    ratings = list(ratings_collection.aggregate([
+        {"$group": {"_id": None, "n": {"$sum": 1}, "avg": {"$avg": "$rating"}}}
+    ]))
+    subs = next(subscriptions_collection.aggregate([{"$facet": {
+        "active": [{"$match": {"status": "active"}}, {"$count": "n"}],
+        "by_plan": [
+            {"$group": {"_id": "$plan", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}
+        ],
+    }}]))
+    return {
+        "total_papers": papers["total"][0]["n"] if papers["total"] else 0,
+        "board_stats": papers["by_board"],
+        "recent_papers": papers["recent"],
+        "total_ratings": ratings[0]["n"] if ratings else 0,
+        "avg_score": round(ratings[0]["avg"], 2) if ratings and ratings[0]["avg"] is not None else 0,
+        "total_subscriptions": subs["active"][0]["n"] if subs["active"] else 0,
+        "sub_stats": subs["by_plan"],
+    }
+
 def render_admin_analytics():
     """Admin analytics dashboard"""
     st.markdown('<div class="admin-card">', unsafe_allow_html=True)
     st.markdown("#### Platform Analytics")
     
     if _mongo_ok:
-        # Get basic stats
-        total_papers = papers_collection.count_documents({})
-        total_ratings = ratings_collection.count_documents({})
-        total_subscriptions = subscriptions_collection.count_documents({"status": "active"})
+        stats = _load_admin_stats()
         
         # Display key metrics
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Total Papers", total_papers)
+            st.metric("Total Papers", stats["total_papers"])
         with col2:
-            st.metric("Total Ratings", total_ratings)
+            st.metric("Total Ratings", stats["total_ratings"])
         with col3:
-            st.metric("Active Subscriptions", total_subscriptions)
+            st.metric("Active Subscriptions", stats["total_subscriptions"])
         with col4:
-            avg_rating = ratings_collection.aggregate([
-                {"$group": {"_id": None, "avg": {"$avg": "$rating"}}}
-            ])
-            avg_val = list(avg_rating)
-            avg_score = round(avg_val[0]["avg"], 2) if avg_val else 0
-            st.metric("Avg Rating", f"{avg_score}")
+            st.metric("Avg Rating", f"{stats['avg_score']}")
         
         # Papers by exam board
         st.markdown("##### Papers by Exam Board")
-        board_stats = papers_collection.aggregate([
-            {"$group": {"_id": "$exam_board", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}
-        ])
-        for stat in board_stats:
+        for stat in stats["board_stats"]:
             st.write(f"**{stat['_id']}:** {stat['count']} papers")
         
         # Subscription stats
         st.markdown("##### Subscription Stats")
-        sub_stats = subscriptions_collection.aggregate([
-            {"$group": {"_id": "$plan", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}
-        ])
-        for stat in sub_stats:
+        for stat in stats["sub_stats"]:
             st.write(f"**{stat['_id'].title()} Plan:** {stat['count']} subscribers")
         
         # Recent activity
         st.markdown("##### Recent Activity")
-        recent_papers = papers_collection.find().sort("uploaded_date", -1).limit(5)
-        for paper in recent_papers:
+        for paper in stats["recent_papers"]:
             upload_date = paper.get('uploaded_date')
             date_str = upload_date.strftime('%Y-%m-%d %H:%M') if upload_date else 'Unknown'
-            st.write(f"**{paper['filename']}** - {date_str}")
\ No newline at end of file
+            st.write(f"**{paper['filename']}** - {date_str}")
+
+_ADMIN_SECTIONS = {
+    "Upload Papers": render_upload_interface,
+    "Manage Content": render_content_management,
+    "Analytics": render_admin_analytics,
+    "Settings": render_admin_settings,
+}
+
+load_deferred_css()